@@ -0,0 +1,328 @@
+import asyncio
+import json
+import multiprocessing
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from minimax import MinimaxSimulation, SearchAborted, State, StateKey, DICE_PROBABILITIES, PLACE_FINISH, \
+    STEPS_IN_FUTURE
+from opening_book import OpeningBook
+
+# Number of searches that can be in flight (running or queued) at the same time
+SEARCH_SLOTS = 1024
+# Number of results in the shared cache (8 bytes each) and entries searched per lookup
+CACHE_ENTRIES = 1 << 20
+CACHE_PROBES = 4
+# Bits of the depth and the piece in a cache entry
+CACHE_DEPTH_BITS = 4
+CACHE_PIECE_BITS = 3
+# Deadline of a search without deadline, a deadline of 0 stops a search
+NO_DEADLINE = float("inf")
+
+SearchKey = Tuple[StateKey, int]
+
+
+
+class SharedCache:
+    """Search results of all sessions, (state key, dice) -> (depth, piece)
+
+    Fixed-size open-addressed table in shared memory. Every entry is a single 64 bit integer holding
+    the whole key and the result, so processes read and write entries without a lock. A full bucket
+    replaces its shallowest entry.
+    """
+
+    def __init__(self, entries: int = CACHE_ENTRIES) -> None:
+        self.table = multiprocessing.Array("q", entries, lock=False)
+
+    def __len__(self) -> int:
+        return len(self.table) - self.table[:].count(0)
+
+    @staticmethod
+    def pack_key(key: SearchKey) -> int:
+        # Places -2..19 need 5 bits, the current player 1 bit and the dice 3 bits
+        # 5 pieces per player: 54 bits, with depth and piece 61 bits
+        (pieces_1, pieces_2, current_player), dice = key
+        packed = 0
+        for place in pieces_1 + pieces_2:
+            packed = packed << 5 | (place - PLACE_FINISH)
+        packed = packed << 1 | (current_player - 1)
+        return packed << 3 | dice
+
+    def bucket(self, packed_key: int) -> range:
+        start = (packed_key * 0x9E3779B97F4A7C15 >> 32) % len(self.table)
+        return range(start, start + CACHE_PROBES)
+
+    def get(self, key: SearchKey) -> Optional[Tuple[int, int]]:
+        packed_key = self.pack_key(key)
+        for index in self.bucket(packed_key):
+            entry = self.table[index % len(self.table)]
+            if entry != 0 and entry >> (CACHE_DEPTH_BITS + CACHE_PIECE_BITS) == packed_key:
+                depth = entry >> CACHE_PIECE_BITS & ((1 << CACHE_DEPTH_BITS) - 1)
+                piece = (entry & ((1 << CACHE_PIECE_BITS) - 1)) - 1
+                return depth, piece
+        return None
+
+    def put(self, key: SearchKey, depth: int, piece: int) -> None:
+        packed_key = self.pack_key(key)
+        depth = min(depth, (1 << CACHE_DEPTH_BITS) - 1)
+        # Depth is at least 1, an entry is never 0 (empty)
+        entry = (packed_key << CACHE_DEPTH_BITS | depth) << CACHE_PIECE_BITS | (piece + 1)
+
+        replace_index = None
+        replace_depth = None
+        for index in self.bucket(packed_key):
+            index %= len(self.table)
+            current = self.table[index]
+            if current == 0 or current >> (CACHE_DEPTH_BITS + CACHE_PIECE_BITS) == packed_key:
+                if current == 0 or current >> CACHE_PIECE_BITS & ((1 << CACHE_DEPTH_BITS) - 1) < depth:
+                    self.table[index] = entry
+                return
+
+            current_depth = current >> CACHE_PIECE_BITS & ((1 << CACHE_DEPTH_BITS) - 1)
+            if replace_depth is None or current_depth < replace_depth:
+                replace_index = index
+                replace_depth = current_depth
+
+        self.table[replace_index] = entry
+
+
+# One simulation per worker process, its transposition table survives between searches
+_worker_simulation: Optional[MinimaxSimulation] = None
+# Shared memory with the deadline (time.time() timestamp) of every search slot
+_worker_deadlines = None
+_worker_cache: Optional[SharedCache] = None
+
+
+def _init_worker(deadlines, cache: SharedCache) -> None:
+    global _worker_simulation, _worker_deadlines, _worker_cache
+    _worker_simulation = MinimaxSimulation()
+    _worker_deadlines = deadlines
+    _worker_cache = cache
+
+
+def _search(position: State, dice: int, depth: int, slot: int) -> Tuple[int, int]:
+    # Runs in a worker process
+    # Iterative deepening until depth is reached or the deadline of the slot passed
+    # The engine moves the deadline while waiters join and leave, 0 cancels the search
+    simulation = _worker_simulation
+    simulation.should_stop = lambda: time.time() >= _worker_deadlines[slot]
+
+    key = (position.key(), dice)
+    piece = -1
+    depth_reached = 0
+
+    # Depth 1 only evaluates the direct moves and is never aborted
+    for current_depth in range(1, depth + 1):
+        try:
+            piece, _ = simulation.best_move(position, dice, current_depth)
+        except SearchAborted:
+            break
+        depth_reached = current_depth
+
+        # Waiters whose deadline passed take the deepest finished result from the cache
+        _worker_cache.put(key, depth_reached, piece)
+
+    return piece, depth_reached
+
+
+@dataclass
+class _Search:
+    future: asyncio.Future
+    slot: int
+    # Deadlines of all waiters, NO_DEADLINE for waiters without deadline
+    deadlines: List[float] = field(default_factory=list)
+
+
+class Engine:
+    """Serves best moves to many concurrent sessions
+
+    Positions of the opening book are answered without a search. Searches run in a process pool.
+    Identical requests in flight share one search, which runs until the latest deadline of its
+    waiters. The results are cached for all sessions in shared memory.
+    """
+
+    def __init__(self, max_workers: Optional[int] = None, depth: int = STEPS_IN_FUTURE,
+                 book: Optional[OpeningBook] = None) -> None:
+        self.depth = depth
+        self.book = book
+        self._simulation = MinimaxSimulation()
+        self._cache = SharedCache()
+        self._deadlines = multiprocessing.Array("d", SEARCH_SLOTS, lock=False)
+        self._free_slots = list(range(SEARCH_SLOTS))
+        self._pool = ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker,
+                                         initargs=(self._deadlines, self._cache))
+        self._in_flight: Dict[SearchKey, _Search] = {}
+
+    async def __aenter__(self) -> "Engine":
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        self.close()
+
+    def close(self) -> None:
+        for search in self._in_flight.values():
+            self._deadlines[search.slot] = 0
+        self._pool.shutdown(cancel_futures=True)
+
+    async def best_move(self, position: State, dice: int, deadline: Optional[float] = None) -> int:
+        """Index of the piece to move (-1 if no piece can move)
+
+        deadline is a time.time() timestamp, the deepest finished result is returned then.
+        """
+        if isinstance(dice, bool) or not isinstance(dice, int) or dice not in range(0, len(DICE_PROBABILITIES)):
+            raise ValueError(f"Dice must be an int between 0 and {len(DICE_PROBABILITIES) - 1}, not {dice!r}")
+        if position.current_player not in [1, 2]:
+            raise ValueError(f"Current player must be 1 or 2, not {position.current_player}")
+
+        if self.book is not None:
+            piece = self.book.lookup(position, dice)
+            if piece is not None:
+                return piece
+
+        key = (position.key(), dice)
+        waiter_deadline = NO_DEADLINE if deadline is None else deadline
+
+        while True:
+            cached = self._cache.get(key)
+            if cached is not None and cached[0] >= self.depth:
+                return cached[1]
+
+            search = self._in_flight.get(key)
+            if search is None:
+                search = self._start_search(key, position, dice)
+
+            piece, depth_reached = await self._wait(key, search, waiter_deadline)
+            if depth_reached is None:
+                # Deadline passed before the search finished
+                cached = self._cache.get(key)
+                if cached is not None:
+                    return cached[1]
+                piece, _ = self._simulation.best_move(position, dice, 1)
+                return piece
+
+            if depth_reached >= self.depth or time.time() >= waiter_deadline:
+                return piece
+            # The search stopped for the deadline of another waiter before this waiter joined
+
+    async def _wait(self, key: SearchKey, search: _Search,
+                    waiter_deadline: float) -> Tuple[int, Optional[int]]:
+        search.deadlines.append(waiter_deadline)
+        self._update_deadline(search)
+        try:
+            timeout = None if waiter_deadline == NO_DEADLINE else max(0.0, waiter_deadline - time.time())
+            return await asyncio.wait_for(asyncio.shield(search.future), timeout)
+        except asyncio.TimeoutError:
+            return -1, None
+        finally:
+            search.deadlines.remove(waiter_deadline)
+            if not search.future.done():
+                if len(search.deadlines) == 0:
+                    # Nobody waits for the result anymore (e.g. client disconnected)
+                    search.future.cancel()
+                    if self._in_flight.get(key) is search:
+                        del self._in_flight[key]
+                self._update_deadline(search)
+
+    def _update_deadline(self, search: _Search) -> None:
+        # The search runs until the latest deadline of its waiters, without waiters it stops
+        self._deadlines[search.slot] = max(search.deadlines, default=0)
+
+    def _start_search(self, key: SearchKey, position: State, dice: int) -> _Search:
+        if len(self._free_slots) == 0:
+            raise RuntimeError("Too many searches in flight")
+
+        loop = asyncio.get_running_loop()
+        slot = self._free_slots.pop()
+        self._deadlines[slot] = 0
+
+        pool_future = self._pool.submit(_search, position, dice, self.depth, slot)
+
+        def release_slot(_) -> None:
+            # The slot is free again when the worker is done, not already when the waiters are gone
+            if not loop.is_closed():
+                loop.call_soon_threadsafe(self._free_slots.append, slot)
+
+        pool_future.add_done_callback(release_slot)
+
+        future = asyncio.wrap_future(pool_future)
+        search = _Search(future, slot)
+        self._in_flight[key] = search
+
+        def finish(done: asyncio.Future) -> None:
+            if self._in_flight.get(key) is search:
+                del self._in_flight[key]
+            if not done.cancelled():
+                # Mark the exception as retrieved, waiters get it through the shield
+                done.exception()
+
+        future.add_done_callback(finish)
+        return search
+
+
+async def _handle_request(engine: Engine, simulation: MinimaxSimulation, request: Dict[str, Any]) -> None:
+    response: Dict[str, Any] = {"id": request.get("id")}
+    try:
+        position = simulation.state_from_pieces(request["pieces_1"], request["pieces_2"],
+                                                request["current_player"])
+        timeout = request.get("timeout")
+        deadline = None if timeout is None else time.time() + timeout
+        response["piece"] = await engine.best_move(position, request["dice"], deadline)
+    except (KeyError, IndexError, TypeError, ValueError) as e:
+        response["error"] = f"invalid request: {e!r}"
+
+    print(json.dumps(response), flush=True)
+
+
+async def serve_stdio(engine: Engine) -> None:
+    """Stand-in server: one JSON request per line on stdin, one JSON response per line on stdout
+
+    Request: {"id": 1, "pieces_1": [...], "pieces_2": [...], "current_player": 1, "dice": 2, "timeout": 1.0}
+    Cancel a running request (e.g. client disconnected): {"id": 1, "cancel": true}
+    """
+    loop = asyncio.get_running_loop()
+    simulation = MinimaxSimulation()
+    tasks: Dict[Any, asyncio.Task] = {}
+
+    while True:
+        line = await loop.run_in_executor(None, sys.stdin.readline)
+        if line == "":
+            break
+        if line.strip() == "":
+            continue
+
+        try:
+            request = json.loads(line)
+        except json.JSONDecodeError as e:
+            print(json.dumps({"id": None, "error": f"invalid request: {e!r}"}), flush=True)
+            continue
+
+        request_id = request.get("id")
+        if request.get("cancel"):
+            task = tasks.pop(request_id, None)
+            if task is not None:
+                task.cancel()
+            continue
+
+        task = asyncio.create_task(_handle_request(engine, simulation, request))
+        tasks[request_id] = task
+        task.add_done_callback(lambda done, request_id=request_id: tasks.pop(request_id, None)
+                               if tasks.get(request_id) is done else None)
+
+    if tasks:
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+
+
+async def main() -> None:
+    # Optional argument: path of an opening book
+    book = OpeningBook.load(Path(sys.argv[1])) if len(sys.argv) > 1 else None
+
+    async with Engine(book=book) as engine:
+        await serve_stdio(engine)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,7 +1,6 @@
-import sys
 from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional, List
+from typing import Callable, Dict, Optional, List, Tuple
 
 import graphviz
 
@@ -47,6 +46,8 @@ EVAL_MULTIPLIER_ROSETTE = 1.5
 EVAL_MULTIPLIER_KILLABLE = 10
 EVAL_MULTIPLIER_ATTACKER = -1.5
 EVAL_ADDER_KILL_HAPPENS = 100
+# Exact score of a won game, every ply until the win reduces it by one (faster wins are preferred)
+EVAL_WIN = 10000
 
 # Constants
 PLACE_ROSETTE = 3
@@ -57,6 +58,18 @@ PLACE_FINISH = -2
 # Visualization
 VIZ_THROWS = [2, 3]
 
+# Search
+# Probability of each dice throw (sum of four binary dice)
+DICE_PROBABILITIES = [1 / 16, 4 / 16, 6 / 16, 4 / 16, 1 / 16]
+SEARCH_CHECK_INTERVAL = 256
+TRANSPOSITION_TABLE_SIZE = 200_000
+
+StateKey = Tuple[Tuple[int, ...], Tuple[int, ...], int]
+
+
+class SearchAborted(Exception):
+    """Raised inside a search when its stop condition (deadline, cancellation) is met"""
+
 
 @dataclass
 class State:
@@ -90,6 +103,10 @@ class State:
 
         return state
 
+    def key(self) -> StateKey:
+        # Board and scores are derived from the pieces
+        return tuple(self.pieces_1), tuple(self.pieces_2), self.current_player
+
     def __str__(self) -> str:
         return (f"\tPosition: {self.pos}\n"
                 f"\tCurrent player: {self.current_player} - other_player: {self.other_player}\n"
@@ -98,14 +115,13 @@ class State:
                 f"\tPieces 1: {self.pieces_1} - Pieces 2: {self.pieces_2}\n"
                 f"\tScore 1: {self.score_1} - Score 2: {self.score_2}\n")
 
-    def check_win(self, player: int) -> None:
+    def check_win(self, player: int) -> bool:
         score_player = player_based_list(self.score_1, self.score_2)[player]
 
-        if score_player == NUM_OF_PIECES_PER_PLAYER:
-            # TODO: Was hier?
-            print_out("Win - Keine Ahnung was jetzt")
-            print("Win")
-            sys.exit(0)
+        return score_player == NUM_OF_PIECES_PER_PLAYER
+
+    def is_finished(self) -> bool:
+        return self.check_win(1) or self.check_win(2)
 
     def swap_player(self) -> None:
         tmp = self.current_player
@@ -210,6 +226,53 @@ class MinimaxSimulation:
         self.start_state = self.state_list.add_new_state(
             State(game_board, score_1, score_2, pieces_1, pieces_2, 1, 2))
 
+        # ----- Search ----- #
+
+        # state key -> (depth, expected value for the current player of the state, wins, value is exact)
+        # Exact values (game is decided in every line) are valid for every depth
+        self.transpositions: Dict[StateKey, Tuple[int, float, float, bool]] = {}
+        self.nodes = 0
+        # Polled during the search, a search is aborted if this returns True
+        self.should_stop: Optional[Callable[[], bool]] = None
+
+    def state_from_pieces(self, pieces_1: List[int], pieces_2: List[int], current_player: int) -> State:
+        if isinstance(current_player, bool) or current_player not in [1, 2]:
+            raise ValueError(f"Current player must be 1 or 2, not {current_player!r}")
+
+        fields_taken = set()
+        for player, pieces in enumerate(player_based_list(pieces_1, pieces_2)):
+            if pieces is None:
+                continue
+
+            if len(pieces) != NUM_OF_PIECES_PER_PLAYER:
+                raise ValueError(f"Player {player} must have {NUM_OF_PIECES_PER_PLAYER} pieces, not {len(pieces)}")
+
+            for place in pieces:
+                if isinstance(place, bool) or not isinstance(place, int):
+                    raise ValueError(f"Place of a piece must be an int, not {place!r}")
+                if place in [PLACE_START, PLACE_FINISH]:
+                    continue
+                if place not in self.paths[player]:
+                    raise ValueError(f"Place {place} is not on the path of player {player}")
+                if place in fields_taken:
+                    raise ValueError(f"Place {place} is taken by more than one piece")
+                fields_taken.add(place)
+
+        game_board = self.game_board.copy()
+        for place in pieces_1:
+            if place not in [PLACE_START, PLACE_FINISH]:
+                game_board[place] += 1
+        for place in pieces_2:
+            if place not in [PLACE_START, PLACE_FINISH]:
+                game_board[place] += 2
+
+        score_1 = pieces_1.count(PLACE_FINISH)
+        score_2 = pieces_2.count(PLACE_FINISH)
+        other_player = 2 if current_player == 1 else 1
+
+        return State(game_board, score_1, score_2, list(pieces_1), list(pieces_2), current_player,
+                     other_player)
+
     def piece_cannot_finish(self, current_player: int, next_path_index: int) -> bool:
         path = self.paths[current_player]
         return next_path_index > len(path)
@@ -256,6 +319,29 @@ class MinimaxSimulation:
             current_player = state_new.other_player
             other_player = state_new.current_player
 
+        points_total = self.evaluation_position(state_new, current_player, other_player)
+        points_total += self.evaluation_improvements(state_source, state_new, other_player)
+
+        return points_total
+
+    def evaluation_improvements(self, state_source: State, state_new: State, other_player: int) -> float:
+        # Points of the move from state_source to state_new itself
+        points_total = 0
+
+        other_pieces_source = player_based_list(state_source.pieces_1, state_source.pieces_2)[other_player]
+        other_pieces_new = player_based_list(state_new.pieces_1, state_new.pieces_2)[other_player]
+
+        count_other_pieces_source_start = sum([1 for a in other_pieces_source if a == PLACE_START])
+        count_other_pieces_new_start = sum([1 for a in other_pieces_new if a == PLACE_START])
+
+        kill_happens = count_other_pieces_new_start != count_other_pieces_source_start
+
+        points_total += kill_happens * EVAL_ADDER_KILL_HAPPENS
+
+        return points_total
+
+    def evaluation_position(self, state_new: State, current_player: int, other_player: int) -> float:
+        # Points of the pieces of current_player, independent of the move leading to state_new
         places = player_based_list(state_new.pieces_1, state_new.pieces_2)
         paths = player_based_list(self.path_1, self.path_2)
 
@@ -303,18 +389,6 @@ class MinimaxSimulation:
                 count_attacker = len(attacker_pieces_of_other_player)
                 points_total += count_attacker * EVAL_MULTIPLIER_ATTACKER
 
-        # ------------ Improvements of state ------------ #
-
-        other_pieces_source = player_based_list(state_source.pieces_1, state_source.pieces_2)[other_player]
-        other_pieces_new = player_based_list(state_new.pieces_1, state_new.pieces_2)[other_player]
-
-        count_other_pieces_source_start = sum([1 for a in other_pieces_source if a == PLACE_START])
-        count_other_pieces_new_start = sum([1 for a in other_pieces_new if a == PLACE_START])
-
-        kill_happens = count_other_pieces_new_start != count_other_pieces_source_start
-
-        points_total += kill_happens * EVAL_ADDER_KILL_HAPPENS
-
         return points_total
 
     def simulate_step(self, current_state: State, piece_index: int, dice: int) -> Optional[State]:
@@ -360,6 +434,8 @@ class MinimaxSimulation:
             # Piece moves to finish
             current_state.piece_move(current_player, piece_index, place_current_piece, PLACE_FINISH)
             scores[current_player] += 1
+            current_state.score_1 = scores[1]
+            current_state.score_2 = scores[2]
 
             state_new = current_state
 
@@ -403,6 +479,122 @@ class MinimaxSimulation:
 
         return state_new
 
+    def next_states(self, current_state: State, dice: int) -> List[State]:
+        states = []
+
+        # A dice of 0 moves no piece, this is handled like "no piece can move"
+        if dice != 0:
+            for piece_index in range(0, NUM_OF_PIECES_PER_PLAYER):
+                state_new = self.simulate_step(current_state.copy(), piece_index, dice)
+                if state_new is not None:
+                    states.append(state_new)
+
+        if len(states) == 0:
+            # No piece can move, the other player continues with the same board
+            state_new = current_state.copy()
+            state_new.dice = dice
+            state_new.swap_player()
+            states.append(state_new)
+
+        return states
+
+    def count_node(self) -> None:
+        self.nodes += 1
+        if self.should_stop is not None and self.nodes % SEARCH_CHECK_INTERVAL == 0 and self.should_stop():
+            raise SearchAborted()
+
+    def value_of_move(self, state_source: State, state_new: State, depth: int) -> Tuple[float, float, bool]:
+        # Value of the move for the current player of state_source, the probability of a win minus the
+        # probability of a loss in the search (wins) and whether the value is exact
+        if state_new.check_win(state_source.current_player):
+            # Finished game is a leaf
+            return EVAL_WIN, 1, True
+
+        if depth <= 1:
+            # Zero-sum leaf: the points of the mover minus the points of the other player
+            value = self.evaluation(state_source, state_new) - \
+                    self.evaluation_position(state_new, state_source.other_player, state_source.current_player)
+            return value, 0, False
+
+        value, wins, exact = self.expected_value(state_new, depth - 1)
+
+        # Every win and loss is one ply further away, this costs one point per win (or loss)
+        value -= wins
+
+        if state_new.current_player != state_source.current_player:
+            # No second throw, the other player moves next
+            value = -value
+            wins = -wins
+
+        if exact:
+            return value, wins, exact
+
+        # The points of the move itself (e.g. a kill) are not part of any later position
+        value += self.evaluation_improvements(state_source, state_new, state_source.other_player)
+        return value, wins, exact
+
+    def best_value(self, state: State, dice: int, depth: int) -> Tuple[int, float, float, bool]:
+        # Best piece to move (-1 if no piece can move), its value, wins and whether the value is exact
+        states_new = self.next_states(state, dice)
+
+        for state_new in states_new:
+            if state_new.check_win(state.current_player):
+                # Immediate win cannot be beaten, other moves are not needed
+                return state_new.moved_piece, EVAL_WIN, 1, True
+
+        best_piece = -1
+        best_value = float("-inf")
+        best_wins = 0
+        best_exact = True
+
+        for state_new in states_new:
+            value, wins, exact = self.value_of_move(state, state_new, depth)
+            best_exact = best_exact and exact
+
+            if value > best_value:
+                best_piece = state_new.moved_piece
+                best_value = value
+                best_wins = wins
+
+            if exact and value >= EVAL_WIN - 1:
+                # Without an immediate win, a sure win after one more ply is the best possible value
+                return best_piece, best_value, best_wins, True
+
+        return best_piece, best_value, best_wins, best_exact
+
+    def expected_value(self, state: State, depth: int) -> Tuple[float, float, bool]:
+        # Value and wins for the current player of state before the dice is thrown and whether the
+        # value is exact
+        key = state.key()
+        entry = self.transpositions.get(key)
+        if entry is not None and (entry[3] or entry[0] == depth):
+            return entry[1], entry[2], entry[3]
+
+        self.count_node()
+
+        value = 0
+        wins = 0
+        exact = True
+        for dice, probability in enumerate(DICE_PROBABILITIES):
+            _, dice_value, dice_wins, dice_exact = self.best_value(state, dice, depth)
+            value += probability * dice_value
+            wins += probability * dice_wins
+            exact = exact and dice_exact
+
+        if len(self.transpositions) >= TRANSPOSITION_TABLE_SIZE:
+            self.transpositions.clear()
+        self.transpositions[key] = (depth, value, wins, exact)
+
+        return value, wins, exact
+
+    def best_move(self, state: State, dice: int, depth: int = STEPS_IN_FUTURE) -> Tuple[int, float]:
+        # Returns the index of the piece to move (-1 if no piece can move) and its value
+        if state.is_finished():
+            raise ValueError("Game is already finished")
+
+        best_piece, best_value, _, _ = self.best_value(state, dice, depth)
+        return best_piece, best_value
+
     def visualize(self) -> None:
         graph = graphviz.Graph(name="Graph")
 
@@ -466,6 +658,13 @@ class MinimaxSimulation:
 
         while current_state is not None:
             for step in range(current_step, STEPS_IN_FUTURE):
+                current_step = step + 1
+
+                if current_state.is_finished():
+                    # Finished game is a leaf, no further steps
+                    print_out(f"Finished state: \n{current_state}")
+                    break
+
                 print_out(f"Step: {step}")
                 print_out(f"Current state: \n{current_state}")
 
@@ -489,11 +688,11 @@ class MinimaxSimulation:
                         state_new = self.state_list.add_new_state(state_new)
                         current_state.children.append(state_new.pos)
 
-                        # ----- Check win ----- #
-                        state_new.check_win(current_state.current_player)
-
                         # ----- Evaluation ----- #
-                        score = self.evaluation(current_state, state_new)
+                        if state_new.check_win(current_state.current_player):
+                            score = EVAL_WIN
+                        else:
+                            score = self.evaluation(current_state, state_new)
                         print_eval(f"{step},{score}")
                         state_new.eval = score
 
@@ -509,9 +708,10 @@ class MinimaxSimulation:
 
                 if len(current_state.children) == 0:
                     # No piece can move. This leads to no child, which would be incorrect. Therefore the same state will be the next state, but with player swap
-                    # TODO: what should evalulation score be?
+                    # The evaluation is the one of the current player's unchanged position
                     state_new = current_state.copy()
                     state_new.swap_player()
+                    state_new.eval = self.evaluation(current_state, state_new)
 
                     state_new.parent_pos = current_state.pos
                     state_new = self.state_list.add_new_state(state_new)
@@ -528,8 +728,6 @@ class MinimaxSimulation:
 
                     current_state = next_state
 
-            current_step = STEPS_IN_FUTURE
-
             next_state = None
             while next_state is None and current_state is not None and current_state.child_iter <= len(
                     current_state.children):
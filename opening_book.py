@@ -0,0 +1,96 @@
+import argparse
+import struct
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from minimax import MinimaxSimulation, State, StateKey, DICE_PROBABILITIES, NUM_OF_PIECES_PER_PLAYER
+
+BOOK_MAGIC = b"URB1"
+BOOK_PLIES = 2
+BOOK_DEPTH = 4
+
+# pieces_1, pieces_2, current_player, dice -> piece
+BOOK_RECORD = struct.Struct(f"<{2 * NUM_OF_PIECES_PER_PLAYER}bBBb")
+BOOK_HEADER = struct.Struct("<4sI")
+
+BookKey = Tuple[StateKey, int]
+
+
+class OpeningBook:
+    """Best moves of all positions reachable in the first plies from the start state"""
+
+    def __init__(self, moves: Optional[Dict[BookKey, int]] = None) -> None:
+        self.moves: Dict[BookKey, int] = {} if moves is None else moves
+
+    def __len__(self) -> int:
+        return len(self.moves)
+
+    def lookup(self, state: State, dice: int) -> Optional[int]:
+        return self.moves.get((state.key(), dice))
+
+    def save(self, path: Path) -> None:
+        with Path(path).open("wb") as file:
+            file.write(BOOK_HEADER.pack(BOOK_MAGIC, len(self.moves)))
+            for ((pieces_1, pieces_2, current_player), dice), piece in self.moves.items():
+                file.write(BOOK_RECORD.pack(*pieces_1, *pieces_2, current_player, dice, piece))
+
+    @staticmethod
+    def load(path: Path) -> "OpeningBook":
+        data = Path(path).read_bytes()
+        if len(data) < BOOK_HEADER.size:
+            raise ValueError(f"'{path}' is not an opening book")
+
+        magic, count = BOOK_HEADER.unpack_from(data)
+        if magic != BOOK_MAGIC or len(data) != BOOK_HEADER.size + count * BOOK_RECORD.size:
+            raise ValueError(f"'{path}' is not an opening book")
+
+        moves = {}
+        for record in BOOK_RECORD.iter_unpack(data[BOOK_HEADER.size:]):
+            pieces_1 = record[:NUM_OF_PIECES_PER_PLAYER]
+            pieces_2 = record[NUM_OF_PIECES_PER_PLAYER:2 * NUM_OF_PIECES_PER_PLAYER]
+            current_player, dice, piece = record[2 * NUM_OF_PIECES_PER_PLAYER:]
+            moves[((pieces_1, pieces_2, current_player), dice)] = piece
+
+        return OpeningBook(moves)
+
+    @staticmethod
+    def generate(plies: int = BOOK_PLIES, depth: int = BOOK_DEPTH,
+                 simulation: Optional[MinimaxSimulation] = None) -> "OpeningBook":
+        """Searches every position reachable in the first plies for every dice throw"""
+        if simulation is None:
+            simulation = MinimaxSimulation()
+
+        book = OpeningBook()
+        seen = {simulation.start_state.key()}
+        current_states = [simulation.start_state]
+
+        for ply in range(0, plies):
+            new_states = []
+            for state in current_states:
+                for dice in range(0, len(DICE_PROBABILITIES)):
+                    piece, _ = simulation.best_move(state, dice, depth)
+                    book.moves[(state.key(), dice)] = piece
+
+                    if ply == plies - 1:
+                        continue
+
+                    for state_new in simulation.next_states(state, dice):
+                        if state_new.key() not in seen:
+                            seen.add(state_new.key())
+                            new_states.append(state_new)
+
+            current_states = new_states
+
+        return book
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate an opening book")
+    parser.add_argument("path", type=Path)
+    parser.add_argument("--plies", type=int, default=BOOK_PLIES)
+    parser.add_argument("--depth", type=int, default=BOOK_DEPTH)
+    args = parser.parse_args()
+
+    opening_book = OpeningBook.generate(args.plies, args.depth)
+    opening_book.save(args.path)
+    print(f"{len(opening_book)} positions written to '{args.path}'")
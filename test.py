@@ -1,6 +1,14 @@
+import asyncio
+import tempfile
+import time
 import unittest
+from pathlib import Path
+from unittest import mock
 
-from minimax import MinimaxSimulation, State, NUM_OF_PIECES_PER_PLAYER, PLACE_START, PLACE_FINISH
+from engine import CACHE_PROBES, Engine, SharedCache
+from minimax import MinimaxSimulation, State, StateList, NUM_OF_PIECES_PER_PLAYER, PLACE_START, PLACE_FINISH, \
+    EVAL_WIN, DICE_PROBABILITIES
+from opening_book import BOOK_HEADER, BOOK_RECORD, OpeningBook
 
 
 class MinimaxTest(unittest.TestCase):
@@ -69,6 +77,7 @@ class MinimaxTest(unittest.TestCase):
 
         expected_state = self.state_default.copy()
         expected_state.pieces_1[piece_index] = PLACE_FINISH
+        expected_state.score_1 = 1
         expected_state.swap_player()
 
         state_new = self.sim.simulate_step(current_state, piece_index, dice)
@@ -159,3 +168,391 @@ class MinimaxTest(unittest.TestCase):
         state_new = self.sim.simulate_step(current_state, piece_index, dice)
 
         self.assertEqual(expected_state, state_new)
+
+    def test9(self) -> None:
+        """No piece can move => Pass state with player swap"""
+        dice = 0
+
+        current_state = self.state_default.copy()
+
+        expected_state = self.state_default.copy()
+        expected_state.swap_player()
+
+        states_new = self.sim.next_states(current_state, dice)
+
+        self.assertEqual(1, len(states_new))
+        self.assertEqual(expected_state.key(), states_new[0].key())
+        self.assertEqual(-1, states_new[0].moved_piece)
+
+    def test10(self) -> None:
+        """Best move catches the other player"""
+        dice = 1
+
+        current_state = self.state_default.copy()
+        current_state.game_board[7] += current_state.current_player
+        current_state.pieces_1[0] = 7
+        current_state.game_board[8] += current_state.other_player
+        current_state.pieces_2[0] = 8
+
+        piece, _ = self.sim.best_move(current_state, dice, 2)
+
+        self.assertEqual(0, piece)
+
+    def test11(self) -> None:
+        """State built from pieces equals the simulated state"""
+        current_state = self.state_default.copy()
+        current_state.game_board[6] += current_state.current_player
+        current_state.pieces_1[0] = 6
+
+        state_new = self.sim.simulate_step(current_state, 0, 1)
+
+        state_from_pieces = self.sim.state_from_pieces(state_new.pieces_1, state_new.pieces_2, 2)
+
+        self.assertEqual(state_new.key(), state_from_pieces.key())
+        self.assertEqual(state_new.game_board, state_from_pieces.game_board)
+
+    def test12(self) -> None:
+        """Winning move is a leaf with exact score, no process exit"""
+        dice = 2
+
+        current_state = self.sim.state_from_pieces([PLACE_FINISH] * 4 + [5], [6, 8, 10, 12, 13], 1)
+
+        piece, value = self.sim.best_move(current_state, dice, 3)
+
+        self.assertEqual(4, piece)
+        self.assertEqual(EVAL_WIN, value)
+
+    def test13(self) -> None:
+        """Win after a second throw scores one less than an immediate win"""
+        dice = 1
+
+        current_state = self.sim.state_from_pieces([PLACE_FINISH] * 4 + [1], [PLACE_START] * 5, 1)
+
+        # Piece moves on the rosette, the same player wins with the second throw for sure
+        state_new = self.sim.simulate_step(current_state.copy(), 4, dice)
+        self.assertTrue(state_new.second_throw)
+        self.sim.transpositions[state_new.key()] = (1, EVAL_WIN, 1, True)
+
+        value, wins, exact = self.sim.value_of_move(current_state, state_new, 2)
+
+        self.assertEqual(EVAL_WIN - 1, value)
+        self.assertEqual(1, wins)
+        self.assertTrue(exact)
+
+    def test14(self) -> None:
+        """Finished game has no best move"""
+        current_state = self.sim.state_from_pieces([PLACE_FINISH] * 5, [PLACE_START] * 5, 2)
+
+        self.assertTrue(current_state.is_finished())
+        with self.assertRaises(ValueError):
+            self.sim.best_move(current_state, 2)
+
+    def test15(self) -> None:
+        """Deeper search still finishes the piece"""
+        dice = 2
+
+        current_state = self.sim.state_from_pieces([5] + [PLACE_START] * 4, [PLACE_START] * 5, 1)
+
+        for depth in range(1, 4 + 1):
+            piece, _ = self.sim.best_move(current_state, dice, depth)
+            self.assertEqual(0, piece, f"depth {depth}")
+
+    def test16(self) -> None:
+        """Current player other than 1 or 2 is rejected"""
+        with self.assertRaises(ValueError):
+            self.sim.state_from_pieces([PLACE_START] * 5, [PLACE_START] * 5, 3)
+
+    def test17(self) -> None:
+        """Exact transposition entries are reused at every depth, others only at their depth"""
+        current_state = self.sim.state_from_pieces([PLACE_FINISH] * 4 + [5], [6, 8, 10, 12, 13], 1)
+
+        self.sim.transpositions[current_state.key()] = (5, -EVAL_WIN, -1, True)
+        value, wins, exact = self.sim.expected_value(current_state, 2)
+
+        self.assertEqual((-EVAL_WIN, -1, True), (value, wins, exact))
+        self.assertEqual(0, self.sim.nodes)
+
+        self.sim.transpositions[current_state.key()] = (5, -EVAL_WIN, -1, False)
+        value, _, _ = self.sim.expected_value(current_state, 2)
+
+        self.assertNotEqual(-EVAL_WIN, value)
+        self.assertGreater(self.sim.nodes, 0)
+
+    def start_from(self, current_state: State) -> None:
+        self.sim.state_list = StateList()
+        self.sim.start_state = self.sim.state_list.add_new_state(current_state)
+
+        with mock.patch.multiple("minimax", VISUALIZE=False, STEPS_IN_FUTURE=3):
+            self.sim.start()
+
+    def test18(self) -> None:
+        """Win within the steps of start() is a leaf with exact score, no process exit"""
+        self.start_from(self.sim.state_from_pieces([PLACE_FINISH] * 4 + [5], [6, 8, 10, 12, 13], 1))
+
+        finished_states = [state for state in self.sim.state_list if state.is_finished()]
+
+        self.assertNotEqual([], finished_states)
+        for state in finished_states:
+            self.assertEqual(EVAL_WIN, state.eval)
+            self.assertEqual([], state.children)
+
+    def test19(self) -> None:
+        """All unfinished states before the last step of start() are expanded"""
+        self.start_from(self.sim.state_from_pieces([PLACE_FINISH] * 4 + [5], [6, 8, 10, 12, 13], 1))
+
+        for state in self.sim.state_list:
+            depth = 0
+            parent = self.sim.state_list.get_parent(state)
+            while parent is not None:
+                depth += 1
+                parent = self.sim.state_list.get_parent(parent)
+
+            if depth < 3 and not state.is_finished():
+                self.assertNotEqual([], state.children)
+
+    def test20(self) -> None:
+        """No piece can move in start() => Pass state with the evaluation of the unchanged position"""
+        with mock.patch.object(self.sim, "simulate_step", return_value=None):
+            self.start_from(self.sim.start_state.copy())
+
+        state_pass = self.sim.state_list.get(self.sim.start_state.children[0])
+
+        self.assertEqual(1, len(self.sim.start_state.children))
+        self.assertEqual(2, state_pass.current_player)
+        self.assertEqual(self.sim.evaluation(self.sim.start_state, state_pass), state_pass.eval)
+        self.assertNotEqual(0, state_pass.eval)
+
+    def test21(self) -> None:
+        """Probable win one ply later scores lower than the same win now"""
+        dice = 1
+
+        current_state = self.sim.state_from_pieces([PLACE_FINISH] * 4 + [5], [PLACE_START] * 5, 1)
+
+        # Piece moves on the rosette, the same player wins with a dice of 1 after the second throw
+        state_new = self.sim.simulate_step(current_state.copy(), 4, dice)
+        self.assertTrue(state_new.second_throw)
+
+        value_now, wins_now, _ = self.sim.expected_value(state_new, 1)
+        value_later, wins_later, _ = self.sim.value_of_move(current_state, state_new, 2)
+
+        self.assertEqual(DICE_PROBABILITIES[1], wins_now)
+        self.assertEqual(wins_now, wins_later)
+        self.assertEqual(value_now - wins_now, value_later)
+        self.assertLess(value_later, value_now)
+
+    def test22(self) -> None:
+        """Exact sure win after the second throw cuts off the other moves"""
+        dice = 1
+
+        current_state = self.sim.state_from_pieces([1] + [PLACE_START] * 4, [PLACE_START] * 5, 1)
+
+        state_new = self.sim.simulate_step(current_state.copy(), 0, dice)
+        self.assertTrue(state_new.second_throw)
+        self.sim.transpositions[state_new.key()] = (1, EVAL_WIN, 1, True)
+
+        with mock.patch.object(self.sim, "value_of_move", wraps=self.sim.value_of_move) as value_of_move:
+            piece, value, wins, exact = self.sim.best_value(current_state, dice, 2)
+
+        self.assertEqual((0, EVAL_WIN - 1, 1, True), (piece, value, wins, exact))
+        self.assertEqual(1, value_of_move.call_count)
+
+
+    def test23(self) -> None:
+        """Invalid pieces are rejected"""
+        invalid_pieces = [
+            # Wrong number of pieces
+            ([PLACE_START] * 4, [PLACE_START] * 5),
+            # Not a place
+            ([-3] + [PLACE_START] * 4, [PLACE_START] * 5),
+            ([20] + [PLACE_START] * 4, [PLACE_START] * 5),
+            ([2.0] + [PLACE_START] * 4, [PLACE_START] * 5),
+            # Not on the path of the player
+            ([17] + [PLACE_START] * 4, [PLACE_START] * 5),
+            ([PLACE_START] * 5, [0] + [PLACE_START] * 4),
+            # Two pieces of one player on the same field
+            ([0, 0] + [PLACE_START] * 3, [PLACE_START] * 5),
+            # Both players on the same field
+            ([8] + [PLACE_START] * 4, [8] + [PLACE_START] * 4),
+        ]
+
+        for pieces_1, pieces_2 in invalid_pieces:
+            with self.assertRaises(ValueError, msg=f"{pieces_1} {pieces_2}"):
+                self.sim.state_from_pieces(pieces_1, pieces_2, 1)
+
+        # Shared fields, start and finish can be used
+        state = self.sim.state_from_pieces([8, 0, PLACE_FINISH, PLACE_START, PLACE_START],
+                                           [9, 14, PLACE_FINISH, PLACE_FINISH, PLACE_START], 1)
+        self.assertEqual(2, state.score_2)
+
+
+class EngineTest(unittest.IsolatedAsyncioTestCase):
+
+    def setUp(self) -> None:
+        self.sim = MinimaxSimulation()
+        self.engine = Engine(max_workers=1, depth=2)
+        self.position = self.sim.state_from_pieces([0] + [PLACE_START] * 4, [14] + [PLACE_START] * 4, 1)
+
+    def tearDown(self) -> None:
+        self.engine.close()
+
+    async def test0(self) -> None:
+        """Engine returns the same move as the simulation, identical requests are coalesced"""
+        dice = 2
+
+        expected_piece, _ = self.sim.best_move(self.sim.start_state, dice, 2)
+
+        pieces = await asyncio.gather(*[self.engine.best_move(self.sim.start_state, dice) for _ in range(3)])
+
+        self.assertEqual([expected_piece] * 3, pieces)
+        self.assertEqual({}, self.engine._in_flight)
+
+    async def test1(self) -> None:
+        """Cancelled request stops the search"""
+        dice = 3
+        key = (self.position.key(), dice)
+
+        self.engine.depth = 8
+        task = asyncio.create_task(self.engine.best_move(self.position, dice))
+        while key not in self.engine._in_flight:
+            await asyncio.sleep(0.01)
+        search = self.engine._in_flight[key]
+        await asyncio.sleep(0.1)
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+        self.assertEqual({}, self.engine._in_flight)
+        self.assertEqual(0, self.engine._deadlines[search.slot])
+
+        # The only worker is free again and searches the next request before its deadline
+        await self.engine.best_move(self.sim.start_state, dice, time.time() + 0.5)
+
+        self.assertIsNotNone(self.engine._cache.get((self.sim.start_state.key(), dice)))
+
+    async def test2(self) -> None:
+        """Positions of the opening book are not searched"""
+        dice = 3
+
+        self.engine.book = OpeningBook({(self.sim.start_state.key(), dice): 4})
+
+        piece = await self.engine.best_move(self.sim.start_state, dice)
+
+        self.assertEqual(4, piece)
+        self.assertEqual(0, len(self.engine._cache))
+
+    async def test3(self) -> None:
+        """Request with an earlier deadline joining a running search gets its deepest result in time"""
+        dice = 3
+
+        self.engine.depth = 8
+        task = asyncio.create_task(self.engine.best_move(self.position, dice))
+        await asyncio.sleep(0.1)
+
+        start = time.time()
+        piece = await self.engine.best_move(self.position, dice, start + 0.2)
+
+        self.assertLess(time.time() - start, 0.5)
+        self.assertIn(piece, range(0, NUM_OF_PIECES_PER_PLAYER))
+        self.assertFalse(task.done())
+
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await task
+
+    async def test4(self) -> None:
+        """Request without deadline joining a search with deadline gets the full depth"""
+        dice = 3
+
+        self.engine.depth = 4
+        task = asyncio.create_task(self.engine.best_move(self.position, dice, time.time() + 0.01))
+        await asyncio.sleep(0)
+
+        piece = await self.engine.best_move(self.position, dice)
+        await task
+
+        self.assertEqual((4, piece), self.engine._cache.get((self.position.key(), dice)))
+
+    async def test5(self) -> None:
+        """Invalid dice is rejected and not cached"""
+        for dice in [-1, 5, 7, 2.0, True]:
+            with self.assertRaises(ValueError):
+                await self.engine.best_move(self.position, dice)
+
+        self.assertEqual(0, len(self.engine._cache))
+
+
+class SharedCacheTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sim = MinimaxSimulation()
+        self.cache = SharedCache(CACHE_PROBES)
+
+    def test0(self) -> None:
+        """Stored results are found, a result is only replaced by a deeper one"""
+        key = (self.sim.start_state.key(), 2)
+
+        self.assertIsNone(self.cache.get(key))
+
+        self.cache.put(key, 3, 1)
+        self.cache.put(key, 2, 4)
+        self.assertEqual((3, 1), self.cache.get(key))
+
+        self.cache.put(key, 4, -1)
+        self.assertEqual((4, -1), self.cache.get(key))
+        self.assertEqual(1, len(self.cache))
+
+    def test1(self) -> None:
+        """Full table replaces its shallowest entry"""
+        keys = [(self.sim.start_state.key(), dice) for dice in range(0, CACHE_PROBES + 1)]
+
+        for depth, key in enumerate(keys[:-1], 2):
+            self.cache.put(key, depth, 0)
+        self.cache.put(keys[-1], 3, 0)
+
+        self.assertEqual(CACHE_PROBES, len(self.cache))
+        self.assertIsNone(self.cache.get(keys[0]))
+        for key in keys[1:]:
+            self.assertIsNotNone(self.cache.get(key))
+
+
+class OpeningBookTest(unittest.TestCase):
+
+    def setUp(self) -> None:
+        self.sim = MinimaxSimulation()
+
+    def test0(self) -> None:
+        """Book contains the searched moves of all positions of the first plies"""
+        book = OpeningBook.generate(plies=2, depth=1, simulation=self.sim)
+
+        for dice in range(0, 5):
+            expected_piece, _ = self.sim.best_move(self.sim.start_state, dice, 1)
+            self.assertEqual(expected_piece, book.lookup(self.sim.start_state, dice))
+
+            for state_new in self.sim.next_states(self.sim.start_state, dice):
+                self.assertIsNotNone(book.lookup(state_new, 2))
+
+    def test1(self) -> None:
+        """Saved book can be loaded"""
+        book = OpeningBook.generate(plies=2, depth=1, simulation=self.sim)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "book.bin"
+            book.save(path)
+            book_loaded = OpeningBook.load(path)
+
+        self.assertEqual(book.moves, book_loaded.moves)
+
+    def test2(self) -> None:
+        """Truncated book is rejected"""
+        book = OpeningBook.generate(plies=1, depth=1, simulation=self.sim)
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = Path(directory) / "book.bin"
+            book.save(path)
+            data = path.read_bytes()
+
+            for size in [len(data) - BOOK_RECORD.size, len(data) - 1, BOOK_HEADER.size - 1]:
+                path.write_bytes(data[:size])
+                with self.assertRaises(ValueError):
+                    OpeningBook.load(path)